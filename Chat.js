@@ -67,15 +67,22 @@ async function importAesKeyFromBase64(keyBase64) {
 async function encryptChunkWithAes(aesKey, chunkArrayBuffer) {
   const iv = crypto.getRandomValues(new Uint8Array(12));
   const cipher = await crypto.subtle.encrypt({ name: 'AES-GCM', iv }, aesKey, chunkArrayBuffer);
-  return { ivBase64: arrayBufferToBase64(iv.buffer), cipherBase64: arrayBufferToBase64(cipher) };
+  return { ivBase64: arrayBufferToBase64(iv.buffer), cipher };
 }
 
 // HTTP helpers for file upload endpoints
-async function uploadChunkToServer(fileId, filename, chunkIndex, totalChunks, ivB64, cipherB64) {
+async function uploadChunkToServer(fileId, filename, chunkIndex, totalChunks, ivB64, cipher) {
   const res = await fetch(`${BACKEND_ORIGIN}/upload_chunk`, {
     method: 'POST',
-    headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ fileId, filename, chunkIndex, totalChunks, iv: ivB64, chunk: cipherB64 })
+    headers: {
+      'Content-Type': 'application/octet-stream',
+      'X-File-Id': fileId,
+      'X-Filename': encodeURIComponent(filename),
+      'X-Chunk-Index': String(chunkIndex),
+      'X-Total-Chunks': String(totalChunks),
+      'X-IV': ivB64
+    },
+    body: cipher
   });
   if (!res.ok) return null;
   return res.json();
@@ -410,13 +417,13 @@ export default function Chat() {
       const start = i * chunkSize, end = Math.min(start + chunkSize, totalSize);
       const chunk = file.slice(start, end);
       const chunkArrayBuffer = await chunk.arrayBuffer();
-      const { ivBase64, cipherBase64 } = await encryptChunkWithAes(aesKey, chunkArrayBuffer);
+      const { ivBase64, cipher } = await encryptChunkWithAes(aesKey, chunkArrayBuffer);
 
-      const resp = await uploadChunkToServer(fileId, filename, i, totalChunks, ivBase64, cipherBase64);
+      const resp = await uploadChunkToServer(fileId, filename, i, totalChunks, ivBase64, cipher);
       if (!resp || !resp.success) {
         throw new Error(`Chunk upload failed at index ${i}`);
       }
-      const cipherLen = (atob(cipherBase64).length);
+      const cipherLen = cipher.byteLength;
       manifest.push(cipherLen);
       uploaded += (end - start);
       progressCb(uploaded, totalSize);
@@ -613,8 +620,10 @@ export default function Chat() {
     }
   };
   const handleReaction = async (messageId, emoji) => {
+    // Clicking an emoji you already reacted with removes it
+    const existing = (messageReactions[messageId] || []).some(r => r.user_id === username && r.emoji === emoji);
     await fetch(`${BACKEND_ORIGIN}/api/messages/${messageId}/react`, {
-      method: 'POST',
+      method: existing ? 'DELETE' : 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ user_id: username, emoji }),
     });
@@ -1,34 +1,82 @@
 # MUST monkey patch before importing networking modules
-import eventlet
-eventlet.monkey_patch()
-
 import os
-import json
+
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "eventlet")
+if ASYNC_MODE == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+elif ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+else:
+    raise RuntimeError(f"Unsupported ASYNC_MODE {ASYNC_MODE!r}; expected 'eventlet' or 'gevent'")
+
+import re
+import shutil
+import mimetypes
+import uuid
 import base64
+import binascii
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
 
-from flask import Flask, request, jsonify, send_from_directory, session
+import orjson
+import redis
+from cachetools import TTLCache
+from flask import Flask, Response, abort, request, jsonify, send_from_directory, session
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
-from sqlalchemy import func
-from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import delete, event, func, inspect, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from message_reactions import message_reactions
-from models import db, User, Message, RoomJoin, MessageReaction  # Import from models.py
+from models import db, User, Message, MessageReader, RoomJoin, MessageReaction  # Import from models.py
 
 # ------------------------------------------------------
 # Utility: Content Safety
 # ------------------------------------------------------
+UNSAFE_KEYWORDS = ["malware", "phishing", "virus", "hack", "abuse"]
+# One alternation matches every keyword in a single pass over the text
+UNSAFE_RE = re.compile("|".join(map(re.escape, UNSAFE_KEYWORDS)), re.IGNORECASE)
+
 def is_content_safe(text):
-    unsafe_keywords = ["malware", "phishing", "virus", "hack", "abuse"]
-    text_lower = (text or "").lower()
-    return not any(kw in text_lower for kw in unsafe_keywords)
+    return UNSAFE_RE.search(text or "") is None
+
+# ------------------------------------------------------
+# JSON: orjson for Flask responses and Socket.IO packets
+# ------------------------------------------------------
+def json_dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode()
+
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        # orjson has no hooks; keyword arguments (e.g. the session serializer's object_hook) need stdlib json
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+class OrjsonSocketIO:
+    # python-socketio only needs a module-like object exposing dumps/loads
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return json_dumps(obj)
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
 
 # ------------------------------------------------------
 # App Setup
 # ------------------------------------------------------
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///chat.db'
 app.config["SECRET_KEY"] = "some_secret_key_for_sessions"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
@@ -36,37 +84,241 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 app.register_blueprint(message_reactions)
 
+def set_sqlite_pragmas(dbapi_conn, _record):
+    # WAL lets readers run alongside the writer; synchronous=NORMAL drops the per-commit fsync
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+    cur.execute("PRAGMA cache_size=-65536")    # 64 MiB
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "pdf", "txt", "doc", "docx"}
+ALLOWED_SUFFIXES = tuple("." + ext for ext in ALLOWED_EXTENSIONS)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# When set (e.g. "/_uploads/"), /uploads/* answers with an X-Accel-Redirect to this internal
+# nginx location, and nginx streams the file itself with sendfile()
+UPLOADS_ACCEL_PREFIX = os.environ.get("UPLOADS_ACCEL_PREFIX")
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
 
 CORS(app, supports_credentials=True)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet")
+# The Redis message queue lets every worker broadcast to every client
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, json=OrjsonSocketIO, message_queue=REDIS_URL)
+
+# ------------------------------------------------------
+# Socket maps
+# ------------------------------------------------------
+users = {}         # sid -> username (sids are per-worker, so this stays in memory)
+sid_rooms = {}     # sid -> {room: username} for the rooms that socket joined
+
+# Room presence lives in Redis so all workers share it. Entries are per socket, tagged with
+# the worker that owns it:
+#   room:<room>:sids  -> hash("<worker_id>/<sid>" -> username)
+#   worker:<id>       -> heartbeat key, expires WORKER_TTL seconds after the worker stops
+# A user is online while any of their sockets is; entries of dead workers are dropped on read.
+presence = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+
+WORKER_ID = uuid.uuid4().hex
+WORKER_TTL = 30          # seconds
+HEARTBEAT_EVERY = 10     # seconds
+
+def worker_key(worker_id):
+    return f"worker:{worker_id}"
+
+def room_sids_key(room):
+    return f"room:{room}:sids"
+
+def presence_field(sid):
+    return f"{WORKER_ID}/{sid}"
+
+def republish_presence():
+    # Re-add this worker's sockets, in case other workers reaped them while heartbeats failed
+    pipe = presence.pipeline()
+    for sid, rooms in list(sid_rooms.items()):
+        for room, username in rooms.items():
+            pipe.hset(room_sids_key(room), presence_field(sid), username)
+    pipe.execute()
+
+def heartbeat():
+    failed = False
+    while True:
+        try:
+            presence.set(worker_key(WORKER_ID), 1, ex=WORKER_TTL)
+            if failed:
+                republish_presence()
+                failed = False
+        except redis.RedisError as e:
+            print("[HEARTBEAT] Redis error:", e)
+            failed = True
+        socketio.sleep(HEARTBEAT_EVERY)
+
+presence.set(worker_key(WORKER_ID), 1, ex=WORKER_TTL)
+socketio.start_background_task(heartbeat)
+
+def alive_workers(worker_ids):
+    worker_ids = list(worker_ids)
+    pipe = presence.pipeline()
+    for worker_id in worker_ids:
+        pipe.exists(worker_key(worker_id))
+    return {w for w, alive in zip(worker_ids, pipe.execute()) if alive}
+
+def live_usernames(rooms_entries):
+    # rooms_entries: {room: {field: username}}. Returns {room: [usernames]} with dead-worker
+    # entries removed from Redis along the way.
+    alive = alive_workers({f.split("/", 1)[0] for entries in rooms_entries.values() for f in entries})
+    result = {}
+    pipe = presence.pipeline()
+    for room, entries in rooms_entries.items():
+        dead = [f for f in entries if f.split("/", 1)[0] not in alive]
+        if dead:
+            pipe.hdel(room_sids_key(room), *dead)
+        result[room] = list({u for f, u in entries.items() if f not in dead})
+    pipe.execute()
+    return result
+
+def online_users(room):
+    return live_usernames({room: presence.hgetall(room_sids_key(room))})[room]
+
+def member_room(room, username):
+    # Per-member Socket.IO room, so a user's sockets can be addressed within one chat room
+    return f"member:{room}:{username}"
+
+# Presence changes are coalesced: rooms are queued and flushed together after a short delay,
+# so a burst of joins/disconnects sends one online_users per room instead of one per event
+ONLINE_USERS_DEBOUNCE = 0.1  # seconds
+pending_online_rooms = set()
+online_flush_scheduled = False
+
+def schedule_online_users(room):
+    global online_flush_scheduled
+    pending_online_rooms.add(room)
+    if not online_flush_scheduled:
+        online_flush_scheduled = True
+        socketio.start_background_task(flush_online_users)
+
+def flush_online_users():
+    global online_flush_scheduled
+    socketio.sleep(ONLINE_USERS_DEBOUNCE)
+    online_flush_scheduled = False
+    rooms = list(pending_online_rooms)
+    pending_online_rooms.clear()
+    pipe = presence.pipeline()
+    for room in rooms:
+        pipe.hgetall(room_sids_key(room))
+    for room, members in live_usernames(dict(zip(rooms, pipe.execute()))).items():
+        socketio.emit("online_users", {"users": members}, room=room)
 
 # ------------------------------------------------------
-# In-memory socket maps
+# Public key cache (LRU, username -> public_key)
 # ------------------------------------------------------
-users = {}         # sid -> username
-rooms_users = {}   # room -> set(usernames)
+# Hits are served from memory. Key writes publish the username on PUBLIC_KEY_CHANNEL, and every
+# worker's listener evicts it. public_key_epoch counts evictions, so a DB read that raced with one
+# is not cached.
+PUBLIC_KEY_CACHE_SIZE = 1024
+PUBLIC_KEY_CHANNEL = "public_key_invalidate"
+public_key_cache = OrderedDict()
+public_key_epoch = 0
+
+def evict_public_key(username=None):
+    global public_key_epoch
+    public_key_epoch += 1
+    if username is None:
+        public_key_cache.clear()
+    else:
+        public_key_cache.pop(username, None)
+
+def cached_public_key(username):
+    public_key = public_key_cache.get(username)
+    if public_key is not None:
+        public_key_cache.move_to_end(username)
+    return public_key
+
+def get_cached_public_key(username):
+    public_key = cached_public_key(username)
+    if public_key:
+        return public_key
+    epoch = public_key_epoch
+    user = User.query.filter_by(username=username).first()
+    public_key = user.public_key if user else None
+    # Misses aren't cached; the user may sign up or publish a key later
+    if public_key and epoch == public_key_epoch:
+        public_key_cache[username] = public_key
+        if len(public_key_cache) > PUBLIC_KEY_CACHE_SIZE:
+            public_key_cache.popitem(last=False)
+    return public_key
+
+def invalidate_public_key(username):
+    evict_public_key(username)
+    presence.publish(PUBLIC_KEY_CHANNEL, username)
+
+def listen_public_key_invalidations():
+    while True:
+        try:
+            pubsub = presence.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(PUBLIC_KEY_CHANNEL)
+            # Invalidations may have been missed while unsubscribed, so start from an empty cache
+            evict_public_key()
+            for message in pubsub.listen():
+                evict_public_key(message["data"])
+        except redis.RedisError as e:
+            print("[PUBLIC_KEY] Invalidation listener error:", e)
+            evict_public_key()
+            socketio.sleep(1)
+
+socketio.start_background_task(listen_public_key_invalidations)
 
 with app.app_context():
+    event.listen(db.engine, "connect", set_sqlite_pragmas)
     db.create_all()
+    # Older databases keep read receipts as JSON in message.readers; move them into message_reader
+    # once, then clear the column so later startups skip it
+    if "readers" in {col["name"] for col in inspect(db.engine).get_columns("message")}:
+        db.session.execute(text(
+            "INSERT OR IGNORE INTO message_reader (message_id, username) "
+            "SELECT m.id, j.value FROM message m, json_each(m.readers) j "
+            "WHERE m.readers IS NOT NULL AND json_valid(m.readers) AND j.type = 'text'"
+        ))
+        db.session.execute(text("UPDATE message SET readers = NULL WHERE readers IS NOT NULL"))
+        db.session.commit()
+    # Older databases may hold duplicate reactions, which would block the unique index below
+    reaction_indexes = {ix["name"] for ix in inspect(db.engine).get_indexes("message_reaction")}
+    if "ux_reaction_msg_user_emoji" not in reaction_indexes:
+        db.session.execute(text(
+            "DELETE FROM message_reaction WHERE id NOT IN "
+            "(SELECT MIN(id) FROM message_reaction GROUP BY message_id, user_id, emoji)"
+        ))
+        db.session.commit()
+    # create_all() skips tables that already exist, so build any missing indexes explicitly
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
 
 # ------------------------------------------------------
-# Delete expired messages periodically
+# Expired messages
 # ------------------------------------------------------
+# Reads filter expired rows out, so the sweep only reclaims space and can run lazily
+EXPIRY_SWEEP_EVERY = 100   # inserts between sweeps
+inserts_since_sweep = 0
+
+def not_expired(now=None):
+    now = now or datetime.now(timezone.utc)
+    return db.or_(Message.expires_at == None, Message.expires_at > now)
+
 def delete_expired_messages():
     now = datetime.now(timezone.utc)
-    expired_msgs = Message.query.filter(Message.expires_at != None, Message.expires_at <= now).all()
-    for msg in expired_msgs:
-        db.session.delete(msg)
+    expired = (Message.expires_at != None, Message.expires_at <= now)
+    # Bulk deletes bypass the ORM cascade, so clear read receipts first
+    expired_ids = db.session.query(Message.id).filter(*expired).scalar_subquery()
+    db.session.query(MessageReader).filter(
+        MessageReader.message_id.in_(expired_ids)
+    ).delete(synchronize_session=False)
+    db.session.query(Message).filter(*expired).delete(synchronize_session=False)
     db.session.commit()
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(delete_expired_messages, "interval", minutes=5)
-scheduler.start()
-
 # ------------------------------------------------------
 # Signup / Login / Logout
 # ------------------------------------------------------
@@ -90,6 +342,7 @@ def signup():
     user.set_password(password)
     db.session.add(user)
     db.session.commit()
+    invalidate_public_key(username)
 
     return jsonify({"success": True, "message": "User created"})
 
@@ -102,7 +355,7 @@ def anonymous_login():
     anon_username = "anon_" + str(uuid.uuid4())[:8]
 
     user = User(email=f"{anon_username}@example.com", username=anon_username, is_anonymous=True, public_key=public_key)
-    user.set_password(uuid.uuid4().hex)
+    user.set_unusable_password()
     db.session.add(user)
     db.session.commit()
 
@@ -118,9 +371,13 @@ def login():
 
     user = User.query.filter_by(email=email).first()
     if user and user.check_password(password):
-        if public_key and public_key != user.public_key:
+        key_changed = bool(public_key) and public_key != user.public_key
+        if key_changed:
             user.public_key = public_key
+        if db.session.is_modified(user):  # new key and/or upgraded password hash
             db.session.commit()
+        if key_changed:
+            invalidate_public_key(user.username)
         session["user_id"] = user.id
         return jsonify({"success": True, "username": user.username, "is_anonymous": user.is_anonymous})
     return jsonify({"error": "Invalid credentials"}), 401
@@ -135,27 +392,33 @@ def logout():
 # ------------------------------------------------------
 @app.route("/public-key/<username>")
 def get_public_key(username):
-    user = User.query.filter_by(username=username).first()
-    if not user or not user.public_key:
+    public_key = get_cached_public_key(username)
+    if not public_key:
         return jsonify({"error": "Public key not found"}), 404
-    return jsonify({"public_key": user.public_key})
+    return jsonify({"public_key": public_key})
 
 # ------------------------------------------------------
 # Room users (for frontend live listing)
 # ------------------------------------------------------
 @app.route("/room-users/<room>")
 def room_users_api(room):
-    return jsonify({"users": list(rooms_users.get(room, set()))})
+    return jsonify({"users": online_users(room)})
 
 # ------------------------------------------------------
 # Uploads
 # ------------------------------------------------------
 def allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    return filename.lower().endswith(ALLOWED_SUFFIXES)
 
-@app.route("/uploads/<filename>")
-def uploaded_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+@app.route("/uploads/<path:filename>")
+def serve_upload(filename):
+    if UPLOADS_ACCEL_PREFIX:
+        if safe_join(UPLOAD_FOLDER, filename) is None:
+            abort(404)
+        resp = Response(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        resp.headers["X-Accel-Redirect"] = UPLOADS_ACCEL_PREFIX + quote(filename)
+        return resp
+    return send_from_directory(UPLOAD_FOLDER, filename)
 
 @app.route("/upload", methods=["POST"])
 def upload_file():
@@ -172,45 +435,87 @@ def upload_file():
 # ------------------------------------------------------
 # Messages endpoints (get/search/delete/edit/read)
 # ------------------------------------------------------
+# Serialized /messages/<room> bodies keyed by (room, username, room version). Writes bump the
+# version in Redis so every worker stops serving the old entry.
+messages_cache = TTLCache(maxsize=512, ttl=60)
+
+def room_version(room):
+    return int(presence.get(f"room:{room}:version") or 0)
+
+def bump_room_version(room):
+    presence.incr(f"room:{room}:version")
+
+# (room, username, room version) -> join_time (None if not joined). on_join bumps the room
+# version, so no worker can serve a join_time from before the latest join.
+join_time_cache = TTLCache(maxsize=4096, ttl=300)
+
+def get_join_time(room, username, version):
+    key = (room, username, version)
+    if key in join_time_cache:
+        return join_time_cache[key]
+    join_time = db.session.query(RoomJoin.join_time).filter_by(room=room, username=username).scalar()
+    join_time_cache[key] = join_time
+    return join_time
+
+def messages_json(msgs):
+    # m.content is already a JSON object, so splice it in as-is instead of decoding and re-encoding it
+    parts = []
+    for m in msgs:
+        meta = json_dumps({
+            "id": m.id,
+            "username": m.username,
+            "file_url": m.file_url,
+            "file_name": m.file_name,
+            "timestamp": m.timestamp.isoformat(),
+            "expires_at": m.expires_at.isoformat() if m.expires_at else None,
+            "delivered": m.delivered,
+            "read": m.read,
+            "delete_on_read": m.delete_on_read,
+            "require_all_read": m.require_all_read
+        })
+        parts.append(meta[:-1] + ',"encrypted_map":' + (m.content or "{}") + "}")
+    return "[" + ",".join(parts) + "]"
+
+def messages_response(msgs):
+    return Response(messages_json(msgs), mimetype="application/json")
+
 @app.route("/messages/<room>")
 def get_messages(room):
     username = request.args.get("username")
+    now = datetime.now(timezone.utc).replace(tzinfo=None)  # stored timestamps are naive UTC
+    version = room_version(room)
+    key = (room, username, version)
+    cached = messages_cache.get(key)
+    if cached:
+        body, next_expiry = cached
+        if next_expiry is None or next_expiry > now:
+            return Response(body, mimetype="application/json")
+
     if username:
-        join_record = RoomJoin.query.filter_by(room=room, username=username).first()
-        if join_record:
-            min_time = join_record.join_time
-            msgs = Message.query.filter(Message.room == room, Message.timestamp >= min_time).order_by(Message.timestamp.asc()).all()
+        min_time = get_join_time(room, username, version)
+        if min_time:
+            msgs = Message.query.filter(Message.room == room, Message.timestamp >= min_time, not_expired()).order_by(Message.timestamp.asc()).all()
         else:
             msgs = []
     else:
-        msgs = Message.query.filter(Message.room == room).order_by(Message.timestamp.asc()).all()
-
-    return jsonify([{
-        "id": m.id,
-        "username": m.username,
-        "encrypted_map": json.loads(m.content) if m.content else {},
-        "file_url": m.file_url,
-        "file_name": m.file_name,
-        "timestamp": m.timestamp.isoformat(),
-        "expires_at": m.expires_at.isoformat() if m.expires_at else None,
-        "delivered": m.delivered,
-        "read": m.read,
-        "delete_on_read": m.delete_on_read,
-        "require_all_read": m.require_all_read
-    } for m in msgs])
+        msgs = Message.query.filter(Message.room == room, not_expired()).order_by(Message.timestamp.asc()).all()
+
+    body = messages_json(msgs)
+    # An entry is only good until the first message in it expires
+    messages_cache[key] = (body, min((m.expires_at for m in msgs if m.expires_at), default=None))
+    return Response(body, mimetype="application/json")
 
 @app.route("/messages/search/<room>")
 def search_messages(room):
     query = (request.args.get("q") or "").strip()
     username = request.args.get("username")
     if username:
-        join_record = RoomJoin.query.filter_by(room=room, username=username).first()
-        if not join_record:
+        min_time = get_join_time(room, username, room_version(room))
+        if not min_time:
             return jsonify([])
-        min_time = join_record.join_time
-        base_q = Message.query.filter(Message.room == room, Message.timestamp >= min_time)
+        base_q = Message.query.filter(Message.room == room, Message.timestamp >= min_time, not_expired())
     else:
-        base_q = Message.query.filter(Message.room == room)
+        base_q = Message.query.filter(Message.room == room, not_expired())
 
     if not query:
         msgs = base_q.order_by(Message.timestamp.asc()).all()
@@ -218,28 +523,21 @@ def search_messages(room):
         search_str = f"%{query.lower()}%"
         msgs = base_q.filter(func.lower(Message.username).like(search_str)).order_by(Message.timestamp.asc()).all()
 
-    return jsonify([{
-        "id": m.id,
-        "username": m.username,
-        "encrypted_map": json.loads(m.content) if m.content else {},
-        "file_url": m.file_url,
-        "file_name": m.file_name,
-        "timestamp": m.timestamp.isoformat(),
-        "expires_at": m.expires_at.isoformat() if m.expires_at else None,
-        "delivered": m.delivered,
-        "read": m.read,
-        "delete_on_read": m.delete_on_read,
-        "require_all_read": m.require_all_read
-    } for m in msgs])
+    return messages_response(msgs)
 
 @app.route("/messages/delete/<int:msg_id>", methods=["DELETE"])
 def delete_message(msg_id):
-    msg = Message.query.get(msg_id)
-    if not msg:
+    # DELETE ... RETURNING hands back the room without a prior SELECT (SQLite 3.35+)
+    room = db.session.execute(
+        delete(Message).where(Message.id == msg_id).returning(Message.room)
+    ).scalar()
+    if room is None:
+        db.session.rollback()
         return jsonify({"error": "Message not found"}), 404
-    db.session.delete(msg)
+    db.session.execute(delete(MessageReader).where(MessageReader.message_id == msg_id))
     db.session.commit()
-    socketio.emit("delete_message", {"id": msg_id}, room=msg.room)
+    bump_room_version(room)
+    socketio.emit("delete_message", {"id": msg_id}, room=room)
     return jsonify({"success": True, "deleted_id": msg_id})
 
 @app.route("/messages/edit/<int:msg_id>", methods=["PUT"])
@@ -248,23 +546,32 @@ def edit_message(msg_id):
     encrypted_map = data.get("encrypted_map") or data.get("encryptedmap")
     if not encrypted_map:
         return jsonify({"error": "No content provided"}), 400
-    msg = Message.query.get(msg_id)
+    msg = db.session.get(Message, msg_id)
     if not msg:
         return jsonify({"error": "Message not found"}), 404
-    msg.content = json.dumps(encrypted_map)
+    msg.content = json_dumps(encrypted_map)
     db.session.commit()
+    bump_room_version(msg.room)
     socketio.emit("editmessage", {"id": msg_id, "encryptedmap": encrypted_map}, room=msg.room)
     return jsonify({"success": True, "id": msg_id})
 
 @app.route("/messages/read/<int:msg_id>", methods=["POST"])
 def mark_read(msg_id):
-    msg = Message.query.get(msg_id)
-    if not msg:
-        return jsonify({"error": "Message not found"}), 404
-    msg.read = True
+    # Only unread rows are touched, so an already-read message costs no write
+    room = db.session.execute(
+        update(Message)
+        .where(Message.id == msg_id, Message.read == False)
+        .values(read=True)
+        .returning(Message.room)
+    ).scalar()
     db.session.commit()
-    socketio.emit("message_read", {"id": msg.id, "room": msg.room}, room=msg.room)
-    return jsonify({"success": True, "id": msg.id})
+    if room is None:
+        if not db.session.get(Message, msg_id):
+            return jsonify({"error": "Message not found"}), 404
+        return jsonify({"success": True, "id": msg_id})
+    bump_room_version(room)
+    socketio.emit("message_read", {"id": msg_id, "room": room}, room=room)
+    return jsonify({"success": True, "id": msg_id})
 
 # ------------------------------------------------------
 # Socket events
@@ -276,16 +583,17 @@ def on_connect():
 @socketio.on("disconnect")
 def on_disconnect():
     sid = request.sid
-    username = users.pop(sid, None)
-    rooms_to_update = []
-    if username:
-        for room, user_set in list(rooms_users.items()):
-            if username in user_set:
-                user_set.remove(username)
-                rooms_to_update.append(room)
+    users.pop(sid, None)
+    # Only this socket's entries go; the user's other sockets keep them online
+    rooms_to_update = list(sid_rooms.pop(sid, {}))
+    if rooms_to_update:
+        pipe = presence.pipeline()
+        for room in rooms_to_update:
+            pipe.hdel(room_sids_key(room), presence_field(sid))
+        pipe.execute()
 
     for room in rooms_to_update:
-        emit("online_users", {"users": list(rooms_users.get(room, set()))}, room=room)
+        schedule_online_users(room)
 
 @socketio.on("join")
 def on_join(data):
@@ -295,34 +603,39 @@ def on_join(data):
     if not username or not room:
         return
 
-    user = User.query.filter_by(username=username).first()
-    if user:
-        if public_key and user.public_key != public_key:
-            user.public_key = public_key
+    # A cached key equal to the one presented means the user exists and is up to date
+    if not (public_key and cached_public_key(username) == public_key):
+        user = User.query.filter_by(username=username).first()
+        if user:
+            if public_key and user.public_key != public_key:
+                user.public_key = public_key
+                db.session.commit()
+                invalidate_public_key(username)
+        else:
+            user = User(email=f"{username}@example.com", username=username, is_anonymous=True, public_key=public_key)
+            user.set_unusable_password()
+            db.session.add(user)
             db.session.commit()
-    else:
-        user = User(email=f"{username}@example.com", username=username, is_anonymous=True, public_key=public_key)
-        user.set_password(os.urandom(8).hex())
-        db.session.add(user)
-        db.session.commit()
+            invalidate_public_key(username)
 
     now = datetime.now(timezone.utc)
-    join_record = RoomJoin.query.filter_by(room=room, username=username).first()
-    if join_record:
-        join_record.join_time = now
-    else:
-        db.session.add(RoomJoin(room=room, username=username, join_time=now))
+    db.session.execute(
+        sqlite_insert(RoomJoin)
+        .values(room=room, username=username, join_time=now)
+        .on_conflict_do_update(index_elements=["room", "username"], set_={"join_time": now})
+    )
     db.session.commit()
+    bump_room_version(room)  # the joiner's history cutoff moved
 
     join_room(room)
+    join_room(member_room(room, username))
     users[request.sid] = username
-    if room not in rooms_users:
-        rooms_users[room] = set()
-    already_in_room = username in rooms_users[room]
-    rooms_users[room].add(username)
+    already_in_room = username in online_users(room)
+    presence.hset(room_sids_key(room), presence_field(request.sid), username)
+    sid_rooms.setdefault(request.sid, {})[room] = username
     if not already_in_room:
         emit("status", {"msg": f"{username} has entered the room."}, room=room, skip_sid=request.sid)
-    emit("online_users", {"users": list(rooms_users[room])}, room=room)
+    schedule_online_users(room)
 
 @socketio.on("leave")
 def on_leave(data):
@@ -332,12 +645,15 @@ def on_leave(data):
         return
 
     leave_room(room)
+    leave_room(member_room(room, username))
     users.pop(request.sid, None)
 
-    if room in rooms_users and username in rooms_users[room]:
-        rooms_users[room].remove(username)
-        emit("online_users", {"users": list(rooms_users[room])}, room=room)
-        emit("status", {"msg": f"{username} has left the room."}, room=room, skip_sid=request.sid)
+    removed = presence.hdel(room_sids_key(room), presence_field(request.sid))
+    sid_rooms.get(request.sid, {}).pop(room, None)
+    if removed:
+        schedule_online_users(room)
+        if username not in online_users(room):
+            emit("status", {"msg": f"{username} has left the room."}, room=room, skip_sid=request.sid)
 
 @socketio.on("message")
 def handle_message(data):
@@ -368,69 +684,92 @@ def handle_message(data):
     msg = Message(
         room=room,
         username=username,
-        content=json.dumps(encrypted_map),
+        content=json_dumps(encrypted_map),
         file_url=file_url,
         file_name=file_name,
         expires_at=expires_at,
         delivered=True,
         read=False,
-        readers="[]",
         delete_on_read=delete_on_read,
         require_all_read=require_all_read,
     )
     db.session.add(msg)
     db.session.commit()
-
-    socketio.emit(
-        "message",
-        {
-            "id": msg.id,
-            "user": username,
-            "plaintext": plaintext,
-            "encrypted_map": encrypted_map,
-            "fileUrl": file_url,
-            "fileName": file_name,
-            "expires_at": msg.expires_at.isoformat() if msg.expires_at else None,
-            "delivered": True,
-            "read": False,
-            "delete_on_read": delete_on_read,
-            "require_all_read": require_all_read,
-        },
-        room=room,
-    )
+    bump_room_version(room)
+
+    payload = {
+        "id": msg.id,
+        "user": username,
+        "plaintext": plaintext,
+        "fileUrl": file_url,
+        "fileName": file_name,
+        "expires_at": msg.expires_at.isoformat() if msg.expires_at else None,
+        "delivered": True,
+        "read": False,
+        "delete_on_read": delete_on_read,
+        "require_all_read": require_all_read,
+    }
+    # Each member only needs their own ciphertext, so send O(1) bytes per socket instead of the whole map.
+    # Targets come from per-socket presence, never from the client-chosen map keys, so the number of
+    # emits is bounded by who is actually connected.
+    for member in set(online_users(room)) | {username}:
+        member_map = {member: encrypted_map[member]} if member in encrypted_map else {}
+        socketio.emit("message", {**payload, "encrypted_map": member_map}, room=member_room(room, member))
+
+    global inserts_since_sweep
+    inserts_since_sweep += 1
+    if inserts_since_sweep >= EXPIRY_SWEEP_EVERY:
+        inserts_since_sweep = 0
+        delete_expired_messages()
 
 @socketio.on("message_seen")
 def message_seen(data):
     msg_id = data.get("id")
-    msg = Message.query.get(msg_id)
+    msg = db.session.get(Message, msg_id)
     username = users.get(request.sid, "Unknown")
     if not msg:
         return
 
-    readers = json.loads(msg.readers or "[]")
-    if username not in readers:
-        readers.append(username)
-        msg.readers = json.dumps(readers)
-        db.session.commit()
+    # Clients re-send message_seen on every re-scroll; skip the write entirely when nothing changes
+    already_reader = db.session.get(MessageReader, (msg.id, username)) is not None
+    if already_reader and msg.read:
+        return
+
+    if not already_reader:
+        db.session.execute(
+            sqlite_insert(MessageReader)
+            .values(message_id=msg.id, username=username)
+            .on_conflict_do_nothing()
+        )
 
     if msg.delete_on_read:
         if not msg.require_all_read:
             if username != msg.username:
                 db.session.delete(msg)
                 db.session.commit()
+                bump_room_version(msg.room)
                 emit("delete_message", {"id": msg_id}, room=msg.room)
                 return
         else:
-            room_users_set = rooms_users.get(msg.room, set())
-            if room_users_set and room_users_set.issubset(set(readers).union({msg.username})):
+            room_users_set = set(online_users(msg.room))
+            others = room_users_set - {msg.username}
+            read_count = 0
+            if others:
+                read_count = MessageReader.query.filter(
+                    MessageReader.message_id == msg.id, MessageReader.username.in_(others)
+                ).count()
+            if room_users_set and read_count == len(others):
                 db.session.delete(msg)
                 db.session.commit()
+                bump_room_version(msg.room)
                 emit("delete_message", {"id": msg_id}, room=msg.room)
                 return
 
-    if not msg.read:
-        msg.read = True
-        db.session.commit()
+    was_read = msg.read
+    msg.read = True
+    db.session.commit()
+    if not was_read:
+        bump_room_version(msg.room)
         emit("message_read", {"id": msg.id, "room": msg.room}, room=msg.room)
 
 @socketio.on("typing")
@@ -447,27 +786,55 @@ def handle_stop_typing(data):
     if room:
         emit("stop_typing", {"user": username}, room=room, include_self=False)
 
-UPLOAD_DIR = os.path.join(os.getcwd(), "uploads")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+def upload_path(name):
+    # Client-supplied names must map to a direct child of UPLOAD_FOLDER; None means reject
+    if not name or secure_filename(name) != name:
+        return None
+    path = os.path.realpath(os.path.join(UPLOAD_FOLDER, name))
+    if os.path.dirname(path) != os.path.realpath(UPLOAD_FOLDER):
+        return None
+    return path
+
+def append_file(outfile, src):
+    # Copy in the kernel where sendfile() supports file-to-file (Linux), else with a bounded buffer
+    outfile.flush()
+    size = os.fstat(src.fileno()).st_size
+    offset = 0
+    try:
+        while offset < size:
+            sent = os.sendfile(outfile.fileno(), src.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except (AttributeError, OSError):
+        src.seek(offset)
+        shutil.copyfileobj(src, outfile, 1 << 20)
 
 @app.route("/upload_chunk", methods=["POST"])
 def upload_chunk():
-    data = request.get_json()
-    file_id = data.get("fileId")
-    filename = data.get("filename")
-    chunk_index = data.get("chunkIndex")
-    iv = data.get("iv")
-    chunk = data.get("chunk")
+    # Metadata travels in headers; the body is the raw ciphertext, streamed straight to disk
+    file_id = request.headers.get("X-File-Id")
+    filename = request.headers.get("X-Filename")
+    chunk_index = request.headers.get("X-Chunk-Index", type=int)
+    iv = request.headers.get("X-IV")
 
-    if not all([file_id, filename, iv, chunk]):
+    if not all([file_id, filename, iv]) or chunk_index is None or not request.content_length:
         return jsonify({"success": False, "error": "Missing fields"}), 400
 
-    dir_path = os.path.join(UPLOAD_DIR, file_id)
+    dir_path = upload_path(file_id)
+    if not dir_path or chunk_index < 0:
+        return jsonify({"success": False, "error": "Invalid fileId or chunk index"}), 400
+    try:
+        iv_bytes = base64.b64decode(iv, validate=True)
+    except binascii.Error:
+        return jsonify({"success": False, "error": "Invalid IV"}), 400
+
     os.makedirs(dir_path, exist_ok=True)
 
     chunk_path = os.path.join(dir_path, f"{chunk_index:05d}.part")
     with open(chunk_path, "wb") as f:
-        f.write(base64.b64decode(iv) + base64.b64decode(chunk))
+        f.write(iv_bytes)
+        shutil.copyfileobj(request.stream, f, 1 << 20)
 
     return jsonify({"success": True})
 
@@ -480,23 +847,23 @@ def upload_complete():
     if not file_id or not filename:
         return jsonify({"success": False, "error": "Missing fileId or filename"}), 400
 
-    dir_path = os.path.join(UPLOAD_DIR, file_id)
-    if not os.path.exists(dir_path):
+    final_name = f"{file_id}_{secure_filename(filename)}"
+    dir_path = upload_path(file_id)
+    final_path = upload_path(final_name)
+    if not dir_path or not final_path:
+        return jsonify({"success": False, "error": "Invalid fileId or filename"}), 400
+    if not os.path.isdir(dir_path):
         print("[ERROR] Missing chunks folder:", dir_path)
         return jsonify({"success": False, "error": "Missing chunks"}), 404
 
-    final_path = os.path.join(UPLOAD_DIR, f"{file_id}_{filename}")
     with open(final_path, "wb") as outfile:
         for name in sorted(os.listdir(dir_path)):
             with open(os.path.join(dir_path, name), "rb") as src:
-                outfile.write(src.read())
+                append_file(outfile, src)
+    shutil.rmtree(dir_path, ignore_errors=True)
 
     print("[UPLOAD_COMPLETE] Assembled:", final_path)
-    return jsonify({"success": True, "url": f"/uploads/{file_id}_{filename}"})
-
-@app.route("/uploads/<path:filename>")
-def serve_upload(filename):
-    return send_from_directory(UPLOAD_DIR, filename)
+    return jsonify({"success": True, "url": f"/uploads/{final_name}"})
 
 # ------------------------------------------------------
 # Run server
@@ -1,4 +1,5 @@
 from flask import Blueprint, request, jsonify
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from models import db, MessageReaction
 
 message_reactions = Blueprint('message_reactions', __name__)
@@ -12,14 +13,36 @@ def react_to_message(message_id):
     emoji = data.get('emoji')
     if not user_id or not emoji:
         return jsonify({'error': 'user_id and emoji required'}), 400
-    reaction = MessageReaction(message_id=message_id, user_id=user_id, emoji=emoji)
-    db.session.add(reaction)
+    # Repeated clicks hit the unique index and are ignored instead of adding duplicate rows
+    added = db.session.execute(
+        sqlite_insert(MessageReaction)
+        .values(message_id=message_id, user_id=user_id, emoji=emoji)
+        .on_conflict_do_nothing()
+    ).rowcount
     db.session.commit()
 
-    socketio.emit('reaction', {'messageId': message_id})
+    if added:
+        socketio.emit('reaction', {'messageId': message_id})
 
     return jsonify({'status': 'reaction added'})
 
+@message_reactions.route('/api/messages/<message_id>/react', methods=['DELETE'])
+def remove_reaction(message_id):
+    from app import socketio  # Late import here to avoid circular import
+
+    data = request.json or {}
+    user_id = data.get('user_id')
+    emoji = data.get('emoji')
+    if not user_id or not emoji:
+        return jsonify({'error': 'user_id and emoji required'}), 400
+    removed = MessageReaction.query.filter_by(message_id=message_id, user_id=user_id, emoji=emoji).delete()
+    db.session.commit()
+
+    if removed:
+        socketio.emit('reaction', {'messageId': message_id})
+
+    return jsonify({'status': 'reaction removed' if removed else 'no reaction'})
+
 @message_reactions.route('/api/messages/<message_id>/reactions', methods=['GET'])
 def get_message_reactions(message_id):
     reactions = MessageReaction.query.filter_by(message_id=message_id).all()
@@ -1,7 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
 
 db = SQLAlchemy()
 
+# Stored for throwaway anonymous identities, which never log in with a password
+UNUSABLE_PASSWORD = "anon-nologin"
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(150), unique=True, nullable=False)
@@ -11,12 +15,33 @@ class User(db.Model):
     public_key = db.Column(db.String(500), nullable=True)
 
     def set_password(self, password):
-        from werkzeug.security import generate_password_hash
-        self.password_hash = generate_password_hash(password)
+        from argon2 import PasswordHasher
+        self.password_hash = PasswordHasher().hash(password)
+
+    def set_unusable_password(self):
+        self.password_hash = UNUSABLE_PASSWORD
 
     def check_password(self, password):
+        # On success the stored hash may be upgraded in place; callers commit if the row is dirty
+        if not password or self.password_hash == UNUSABLE_PASSWORD:
+            return False
+        if self.password_hash.startswith("$argon2"):
+            from argon2 import PasswordHasher
+            from argon2.exceptions import VerificationError, InvalidHashError
+            hasher = PasswordHasher()
+            try:
+                hasher.verify(self.password_hash, password)
+            except (VerificationError, InvalidHashError):
+                return False
+            if hasher.check_needs_rehash(self.password_hash):
+                self.password_hash = hasher.hash(password)
+            return True
+        # Accounts created before the switch still carry werkzeug pbkdf2 hashes; move them to argon2
         from werkzeug.security import check_password_hash
-        return check_password_hash(self.password_hash, password)
+        if not check_password_hash(self.password_hash, password):
+            return False
+        self.set_password(password)
+        return True
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -29,9 +54,18 @@ class Message(db.Model):
     expires_at = db.Column(db.DateTime, nullable=True)
     delivered = db.Column(db.Boolean, default=False)
     read = db.Column(db.Boolean, default=False)
-    readers = db.Column(db.Text, default="[]")
+    readers = db.relationship("MessageReader", cascade="all, delete-orphan")
     delete_on_read = db.Column(db.Boolean, default=False)
     require_all_read = db.Column(db.Boolean, default=False)
+    __table_args__ = (
+        db.Index("ix_msg_room_ts", "room", "timestamp"),
+        # Partial: only messages with an expiry are indexed, keeping the sweep cheap
+        db.Index("ix_msg_exp_live", "expires_at", sqlite_where=text("expires_at IS NOT NULL")),
+    )
+
+class MessageReader(db.Model):
+    message_id = db.Column(db.Integer, db.ForeignKey("message.id"), primary_key=True)
+    username = db.Column(db.String(50), primary_key=True)
 
 class RoomJoin(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -45,3 +79,5 @@ class MessageReaction(db.Model):
     message_id = db.Column(db.String(100), nullable=False)
     user_id = db.Column(db.String(100), nullable=False)
     emoji = db.Column(db.String(50), nullable=False)
+    # One row per (message, user, emoji); message_id leads, so it also serves per-message lookups
+    __table_args__ = (db.Index("ux_reaction_msg_user_emoji", "message_id", "user_id", "emoji", unique=True),)